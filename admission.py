@@ -0,0 +1,303 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, jsonify, Response
+from db_utils import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# "memory" keeps buckets per worker process, "postgres" shares them across workers
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory")
+
+# Number of reverse proxies in front of the app whose X-Forwarded-For can be trusted.
+# With 0, every client behind a proxy shares the proxy's address and so its buckets.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 0))
+
+# How long a request may wait for a free slot before it is shed
+DEFAULT_QUEUE_TIMEOUT = 10
+
+# Buckets idle long enough to have refilled are dropped every SWEEP_INTERVAL seconds;
+# MAX_MEMORY_BUCKETS bounds the in-memory store in between (least recently used go first)
+SWEEP_INTERVAL = 60
+MAX_MEMORY_BUCKETS = 100000
+
+
+class MemoryRateLimitStore:
+    """Token buckets held in process memory."""
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst):
+        """Take one token from the bucket. Returns (allowed, retry_after_seconds)."""
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > MAX_MEMORY_BUCKETS:
+                self._buckets.popitem(last=False)
+
+            return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def sweep(self, idle_before):
+        """Drop buckets not touched since idle_before; they are full again by then."""
+        with self._lock:
+            # Entries are kept in update order, so stale ones are at the front
+            while self._buckets:
+                key, (tokens, updated_at) = next(iter(self._buckets.items()))
+                if updated_at >= idle_before:
+                    break
+                del self._buckets[key]
+
+
+class PostgresRateLimitStore:
+    """Token buckets stored in Postgres so every worker sees the same limits."""
+
+    def __init__(self):
+        self._table_ready = False
+
+    def _ensure_table(self, cursor):
+        if not self._table_ready:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    tokens DOUBLE PRECISION NOT NULL,
+                    updated_at DOUBLE PRECISION NOT NULL
+                )
+            """)
+            self._table_ready = True
+
+    def consume(self, key, rate, burst):
+        """Take one token from the bucket. Returns (allowed, retry_after_seconds)."""
+        now = time.time()
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    self._ensure_table(cursor)
+                    cursor.execute("""
+                        INSERT INTO rate_limits (key, tokens, updated_at)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (key) DO NOTHING
+                    """, (key, burst, now))
+
+                    # Lock the bucket row so concurrent workers refill/consume it in turn
+                    cursor.execute(
+                        "SELECT tokens, updated_at FROM rate_limits WHERE key = %s FOR UPDATE",
+                        (key,)
+                    )
+                    tokens, updated_at = cursor.fetchone()
+                    tokens = min(burst, tokens + max(0, now - updated_at) * rate)
+
+                    allowed = tokens >= 1
+                    if allowed:
+                        tokens -= 1
+
+                    cursor.execute(
+                        "UPDATE rate_limits SET tokens = %s, updated_at = %s WHERE key = %s",
+                        (tokens, now, key)
+                    )
+                    conn.commit()
+
+            return allowed, 0 if allowed else (1 - tokens) / rate
+
+        except Exception as e:
+            # Fail open: an unavailable limiter should not take the API down with it
+            logger.error(f"Rate limit store error: {str(e)}")
+            return True, 0
+
+    def sweep(self, idle_before):
+        """Delete buckets not touched since idle_before; they are full again by then."""
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    self._ensure_table(cursor)
+                    cursor.execute("DELETE FROM rate_limits WHERE updated_at < %s", (idle_before,))
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"Rate limit sweep error: {str(e)}")
+
+
+class ConcurrencyLimiter:
+    """Caps in-flight requests for a route, with a bounded queue of waiters."""
+
+    def __init__(self, max_concurrent, max_queue):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout):
+        """Wait for a free slot. Returns None on success or the reason for rejection."""
+        with self._cond:
+            if self.in_flight < self.max_concurrent:
+                self.in_flight += 1
+                return None
+
+            if self.waiting >= self.max_queue:
+                return "queue_full"
+
+            self.waiting += 1
+            try:
+                admitted = self._cond.wait_for(
+                    lambda: self.in_flight < self.max_concurrent, timeout=timeout
+                )
+            finally:
+                self.waiting -= 1
+
+            if not admitted:
+                return "queue_timeout"
+
+            self.in_flight += 1
+            return None
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+_store = PostgresRateLimitStore() if RATE_LIMIT_STORE == "postgres" else MemoryRateLimitStore()
+_limiters = {}
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+# Longest time any registered bucket takes to refill from empty
+_max_refill_seconds = 0
+_last_sweep = time.time()
+_sweep_lock = threading.Lock()
+_proxy_warning_logged = False
+
+
+def _maybe_sweep():
+    global _last_sweep
+    now = time.time()
+    if now - _last_sweep < SWEEP_INTERVAL or not _sweep_lock.acquire(blocking=False):
+        return
+    try:
+        _last_sweep = now
+        _store.sweep(now - _max_refill_seconds)
+    finally:
+        _sweep_lock.release()
+
+
+def _record(name, event):
+    with _metrics_lock:
+        counters = _metrics.setdefault(name, {})
+        counters[event] = counters.get(event, 0) + 1
+
+
+def get_admission_metrics():
+    """Snapshot of admitted/shed request counters and current load per route."""
+    with _metrics_lock:
+        snapshot = {name: dict(counters) for name, counters in _metrics.items()}
+
+    for name, limiter in _limiters.items():
+        route = snapshot.setdefault(name, {})
+        route["in_flight"] = limiter.in_flight
+        route["waiting"] = limiter.waiting
+        route["max_concurrent"] = limiter.max_concurrent
+        route["max_queue"] = limiter.max_queue
+
+    return snapshot
+
+
+def _client_keys():
+    """Bucket keys for the caller: always the peer IP, plus the user_id when one is sent.
+
+    user_id is client-supplied, so it only ever narrows the limit on top of the IP
+    bucket. remote_addr is the real peer unless ProxyFix is configured in front.
+    """
+    global _proxy_warning_logged
+    if not TRUSTED_PROXY_HOPS and not _proxy_warning_logged and request.headers.get('X-Forwarded-For'):
+        _proxy_warning_logged = True
+        logger.warning(
+            "Requests carry X-Forwarded-For but TRUSTED_PROXY_HOPS is 0; all clients behind "
+            "the proxy share one rate limit bucket. Set TRUSTED_PROXY_HOPS to the proxy count."
+        )
+
+    keys = [f"ip:{request.remote_addr}"]
+
+    data = request.get_json(silent=True)
+    user_id = data.get('user_id') if isinstance(data, dict) else None
+    user_id = user_id or request.args.get('user_id')
+    if user_id:
+        keys.append(f"user:{user_id}")
+
+    return keys
+
+
+def _reject(name, reason, retry_after):
+    _record(name, reason)
+    logger.warning(f"Shedding request on {name}: {reason}")
+    response = jsonify({"error": "Too many requests, please try again later"})
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response, 429
+
+
+def _route_limits(name, rate, burst):
+    """Apply a RATE_LIMIT_<NAME>="rate,burst" environment override, if set."""
+    override = os.environ.get(f"RATE_LIMIT_{name.upper()}")
+    if not override:
+        return rate, burst
+    try:
+        rate, burst = override.split(",")
+        return float(rate), float(burst)
+    except ValueError:
+        raise ValueError(f"RATE_LIMIT_{name.upper()} must be 'rate,burst', got {override!r}")
+
+
+def admission_control(name, max_concurrent, max_queue, rate, burst,
+                      queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+    """Decorator applying per-client rate limiting and per-route concurrency limits.
+
+    rate is the number of requests per second a client may sustain and burst the
+    size of its token bucket; both can be overridden with RATE_LIMIT_<NAME>.
+    """
+    global _max_refill_seconds
+    rate, burst = _route_limits(name, rate, burst)
+    limiter = ConcurrencyLimiter(max_concurrent, max_queue)
+    _limiters[name] = limiter
+    _max_refill_seconds = max(_max_refill_seconds, burst / rate)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            _maybe_sweep()
+
+            # Check the IP bucket first so made-up user_ids cannot create buckets unchecked
+            for key in _client_keys():
+                allowed, retry_after = _store.consume(f"{name}:{key}", rate, burst)
+                if not allowed:
+                    return _reject(name, "rate_limited", retry_after)
+
+            reason = limiter.acquire(queue_timeout)
+            if reason:
+                return _reject(name, reason, queue_timeout)
+
+            _record(name, "admitted")
+            held = False
+            try:
+                result = view(*args, **kwargs)
+                if isinstance(result, Response) and result.is_streamed:
+                    # Keep the slot until the streamed body has been fully sent
+                    result.call_on_close(limiter.release)
+                    held = True
+                return result
+            finally:
+                if not held:
+                    limiter.release()
+
+        return wrapper
+
+    return decorator
@@ -1,30 +1,63 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 import psycopg2
 import pytz
 import logging
 from datetime import datetime
 from db_utils import get_db_connection
+from queries import run_query, get_query_stats
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import time
+import os
+import hmac
+from functools import wraps
 from opencage.geocoder import OpenCageGeocode
 from gradio_client import Client, handle_file
+from image_utils import (
+    ImageValidationError, prepare_image, cleanup_images,
+    BIN_DETECTION_SIZE, WASTE_CLASSIFICATION_SIZE
+)
+from admission import admission_control, get_admission_metrics, TRUSTED_PROXY_HOPS
+from export_utils import ExportError, plan_export, stream_export
+from scheduling import (
+    SlotUnavailableError, book_slot, release_slot, get_availability,
+    get_slot_settings, update_slot_settings, within_hours, parse_date, parse_time,
+    slot_start, on_slot_grid, SLOT_MINUTES, MAX_AVAILABILITY_DAYS
+)
 
 app = Flask(__name__)  
 CORS(app)
 
+# Take the client address from X-Forwarded-For only through the configured number of proxies
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 HF_BIN_DETECTION_SPACE = "BinWin/BinWin"
 HF_WASTE_CLASSIFICATION_SPACE = "BinWin/Wasteclassification"
 
-def count_bins(image_url):
-    """Send an image to the Hugging Face Space and get the bin count."""
+# Admin endpoints (exports, metrics) are disabled unless an admin token is configured
+ADMIN_EXPORT_TOKEN = os.environ.get("ADMIN_EXPORT_TOKEN")
+
+def admin_required(view):
+    """Only allow requests carrying the admin token in the X-Admin-Token header."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_EXPORT_TOKEN or not hmac.compare_digest(token, ADMIN_EXPORT_TOKEN):
+            return jsonify({"error": "Unauthorized"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def count_bins(image_path):
+    """Send a prepared image to the Hugging Face Space and get the bin count."""
     try:
         client = Client(HF_BIN_DETECTION_SPACE)
         result = client.predict(
-            handle_file(image_url),  # Process image URL
+            handle_file(image_path),  # Local downsized image
             api_name="/predict"
         )
 
@@ -35,12 +68,12 @@ def count_bins(image_url):
         print(f"❌ Error processing image: {str(e)}")
         return None
 
-def classify_waste(image_url):
-    """Send an image to the Hugging Face Space for waste classification."""
+def classify_waste(image_path):
+    """Send a prepared image to the Hugging Face Space for waste classification."""
     try:
         client = Client(HF_WASTE_CLASSIFICATION_SPACE)
         result = client.predict(
-            handle_file(image_url),  # Process image URL
+            handle_file(image_path),  # Local downsized image
             api_name="/predict"
         )
 
@@ -52,6 +85,7 @@ def classify_waste(image_url):
         return "error"
     
 @app.route('/signup', methods=['POST'])
+@admission_control('signup', max_concurrent=8, max_queue=16, rate=0.2, burst=5)
 def signup():
     """Endpoint for user signup."""
     try:
@@ -99,6 +133,7 @@ def signup():
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 @app.route('/login', methods=['POST'])
+@admission_control('login', max_concurrent=8, max_queue=16, rate=0.5, burst=10)
 def login():
     """Endpoint for user login."""
     try:
@@ -112,15 +147,13 @@ def login():
 
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                query = "SELECT id, email, password, role, time FROM users WHERE email = %s"
-                cursor.execute(query, (email,))
+                run_query(cursor, "login_lookup", (email,))
                 user = cursor.fetchone()
 
                 if user and check_password_hash(user[2], password):
                     # Update last login time
-                    update_query = "UPDATE users SET time = %s WHERE email = %s"
                     current_time = datetime.now(pytz.utc)
-                    cursor.execute(update_query, (current_time, email))
+                    run_query(cursor, "login_touch", (current_time, email))
                     conn.commit()
 
                     return jsonify({
@@ -152,13 +185,7 @@ def submit_score():
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
                 # Update the points in user_profile by adding the new score
-                update_query = """
-                UPDATE user_profile 
-                SET points = COALESCE(points, 0) + %s 
-                WHERE user_id = %s
-                RETURNING user_id, points
-                """
-                cursor.execute(update_query, (score, user_id))
+                run_query(cursor, "quiz_add_points", (score, user_id))
                 updated_user = cursor.fetchone()
                 conn.commit()
 
@@ -185,6 +212,7 @@ def get_coordinates(location):
     return None
 
 @app.route('/getprofile', methods=['POST'])
+@admission_control('getprofile', max_concurrent=8, max_queue=16, rate=0.5, burst=5)
 def get_profile():
     """Create or update user profile."""
     try: 
@@ -201,7 +229,7 @@ def get_profile():
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
                 # Check if the profile exists by user_id
-                cursor.execute("SELECT id FROM user_profile WHERE user_id = %s", (user_id,))
+                run_query(cursor, "profile_exists", (user_id,))
                 existing_profile = cursor.fetchone()
 
                 if existing_profile:
@@ -258,12 +286,7 @@ def display_profile():
 
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                query = """
-                    SELECT id, user_id, name, bio, location, age, profile_image, coordinates, 
-                           level, points, visit, streaks, waste_weight 
-                    FROM user_profile WHERE user_id = %s
-                """
-                cursor.execute(query, (user_id,))
+                run_query(cursor, "profile_fetch", (user_id,))
                 profile = cursor.fetchone()
 
                 if not profile:
@@ -291,6 +314,7 @@ def display_profile():
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 @app.route('/getcompanyprofile', methods=['POST'])
+@admission_control('getcompanyprofile', max_concurrent=8, max_queue=16, rate=0.5, burst=5)
 def get_company_profile():
     """Create or update company profile."""
     try:
@@ -306,7 +330,7 @@ def get_company_profile():
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
                 # Check if the company profile exists
-                cursor.execute("SELECT id FROM company_profile WHERE user_id = %s", (user_id,))
+                run_query(cursor, "company_profile_exists", (user_id,))
                 existing_profile = cursor.fetchone()
 
                 if existing_profile:
@@ -366,13 +390,7 @@ def display_company_profile():
 
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                query = """
-                    SELECT id, user_id, company_name, location, coordinates, contact_number, 
-                           profile_image, visit, building_images
-                    FROM company_profile
-                    WHERE user_id = %s;
-                """
-                cursor.execute(query, (user_id,))
+                run_query(cursor, "company_profile_fetch", (user_id,))
                 profile = cursor.fetchone()
 
                 if not profile:
@@ -397,9 +415,88 @@ def display_company_profile():
         logging.error(f"Error retrieving company profile: {str(e)}")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
+PROFILE_FIELDS = ["id", "user_id", "name", "bio", "location", "age", "profile_image", "coordinates",
+                  "level", "points", "visit", "streaks", "waste_weight"]
+COMPANY_PROFILE_FIELDS = ["id", "user_id", "company_name", "location", "coordinates", "contact_number",
+                          "profile_image", "visit", "building_images"]
+MAX_BATCH_IDS = 100
+
+@app.route('/batchprofiles', methods=['POST'])
+def batch_profiles():
+    """Retrieve many user and company profiles in one request, keyed by user_id."""
+    try:
+        data = request.get_json() or {}
+        user_ids = data.get('user_ids') or []
+        company_ids = data.get('company_ids') or []
+        fields = data.get('fields')
+
+        if not isinstance(user_ids, list) or not isinstance(company_ids, list):
+            return jsonify({"error": "user_ids and company_ids must be lists"}), 400
+
+        if not user_ids and not company_ids:
+            return jsonify({"error": "user_ids or company_ids is required"}), 400
+
+        if len(user_ids) + len(company_ids) > MAX_BATCH_IDS:
+            return jsonify({"error": f"At most {MAX_BATCH_IDS} ids can be requested at once"}), 400
+
+        # Only whole numbers or digit strings; int() would also accept 1.9 or true
+        def is_id(value):
+            if isinstance(value, str):
+                return value.isascii() and value.isdigit()
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        if not all(is_id(i) for i in user_ids + company_ids):
+            return jsonify({"error": "ids must be integers"}), 400
+
+        user_ids = sorted({int(uid) for uid in user_ids})
+        company_ids = sorted({int(cid) for cid in company_ids})
+
+        if fields is not None:
+            if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+                return jsonify({"error": "fields must be a list of strings"}), 400
+            unknown = set(fields) - set(PROFILE_FIELDS) - set(COMPANY_PROFILE_FIELDS)
+            if unknown:
+                return jsonify({"error": f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+
+        def select_fields(columns, row):
+            profile = dict(zip(columns, row))
+            if fields is None:
+                return profile
+            return {key: value for key, value in profile.items() if key in fields or key == "user_id"}
+
+        users = {}
+        companies = {}
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                # One query per table regardless of how many ids were requested
+                if user_ids:
+                    run_query(cursor, "profile_batch", (user_ids,))
+                    for row in cursor.fetchall():
+                        users[row[1]] = select_fields(PROFILE_FIELDS, row)
+
+                if company_ids:
+                    run_query(cursor, "company_profile_batch", (company_ids,))
+                    for row in cursor.fetchall():
+                        companies[row[1]] = select_fields(COMPANY_PROFILE_FIELDS, row)
+
+        return jsonify({
+            "users": {str(uid): profile for uid, profile in users.items()},
+            "companies": {str(cid): profile for cid, profile in companies.items()},
+            "missing": {
+                "users": [uid for uid in user_ids if uid not in users],
+                "companies": [cid for cid in company_ids if cid not in companies]
+            }
+        }), 200
+
+    except Exception as e:
+        logging.error(f"Batch profile retrieval error: {str(e)}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
 @app.route('/wasteUpload', methods=['POST'])
+@admission_control('wasteUpload', max_concurrent=4, max_queue=8, rate=0.1, burst=3, queue_timeout=30)
 def process_waste_image():
     """Endpoint to process waste images and store in Neon DB."""
+    image_paths = []
     try:
         data = request.get_json()
         level = data.get('level')
@@ -413,8 +510,19 @@ def process_waste_image():
         if not isinstance(top_views, list) or len(top_views) > 3:
             return jsonify({"error": "top_views must be a list of max 3 URLs"}), 400
 
+        # Step 0: Fetch each image once, validate it and downsize to the model input size
+        try:
+            front_view_path = prepare_image(front_view, BIN_DETECTION_SIZE)
+            image_paths.append(front_view_path)
+            top_view_paths = []
+            for tv in top_views:
+                top_view_paths.append(prepare_image(tv, WASTE_CLASSIFICATION_SIZE))
+                image_paths.append(top_view_paths[-1])
+        except ImageValidationError as e:
+            return jsonify({"error": str(e)}), 400
+
         # Step 1: Count bins using YOLO on the front_view image
-        bin_count = count_bins(front_view)
+        bin_count = count_bins(front_view_path)
 
         if bin_count is None:
             return jsonify({"error": "Error processing front view image"}), 500
@@ -427,7 +535,7 @@ def process_waste_image():
             }), 400
 
          # Step 3: Classify waste in each bin
-        classification_results = [classify_waste(tv) for tv in top_views]
+        classification_results = [classify_waste(tv) for tv in top_view_paths]
 
         # Check if any classification contains more than one unique class (not properly sorted)
         improperly_sorted = any(len(set(result)) > 1 for result in classification_results)
@@ -472,6 +580,8 @@ def process_waste_image():
     except Exception as e:
         logging.error(f"Process waste image error: {str(e)}")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+    finally:
+        cleanup_images(image_paths)
     
 @app.route('/leaderboard', methods=['GET'])
 def leaderboard():
@@ -479,13 +589,7 @@ def leaderboard():
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                query = """
-                    SELECT user_id, name, profile_image, points, streaks
-                    FROM user_profile
-                    ORDER BY points DESC
-                    LIMIT 20
-                """
-                cursor.execute(query)
+                run_query(cursor, "leaderboard")
                 leaderboard_data = cursor.fetchall()
 
                 # Format response
@@ -514,8 +618,7 @@ def get_all_user_profiles():
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                query = "SELECT user_id, name, bio, coordinates FROM user_profile WHERE coordinates IS NOT NULL"
-                cursor.execute(query)
+                run_query(cursor, "user_locations")
                 profiles = cursor.fetchall()
 
         # Format response
@@ -548,8 +651,7 @@ def display_company_coordinates():
 
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                query = "SELECT company_name, coordinates FROM company_profile WHERE user_id = %s AND coordinates IS NOT NULL"
-                cursor.execute(query, (user_id,))
+                run_query(cursor, "company_location", (user_id,))
                 company = cursor.fetchone()
 
                 if not company:
@@ -586,8 +688,26 @@ def create_schedule():
         if not all([company_id, user_id, date, time]):
             return jsonify({"error": "Missing required fields"}), 400
 
+        try:
+            company_id = int(company_id)
+        except (TypeError, ValueError):
+            return jsonify({"error": "company_id must be an integer"}), 400
+
+        try:
+            slot_date = parse_date(date)
+            slot = slot_start(time)
+        except ValueError:
+            return jsonify({"error": "date must be YYYY-MM-DD and time HH:MM"}), 400
+
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
+                capacity, open_time, close_time = get_slot_settings(cursor, company_id)
+                if not within_hours(slot, open_time, close_time):
+                    return jsonify({"error": "Requested time is outside the company's pickup hours"}), 400
+
+                # Reserve the slot first; the insert only happens if it is not full
+                book_slot(cursor, company_id, slot_date, slot, capacity)
+
                 query = """
                 INSERT INTO scheduling (company_id, user_id, date, time)
                 VALUES (%s, %s, %s, %s)
@@ -597,6 +717,8 @@ def create_schedule():
 
         return jsonify({"message": "Schedule created successfully"}), 201
 
+    except SlotUnavailableError as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         logging.error(f"Error inserting schedule: {str(e)}")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
@@ -613,13 +735,7 @@ def get_user_schedule():
 
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                query = """
-                SELECT s.id , s.company_id, s.date, s.time, c.company_name, c.contact_number, c.profile_image, c.price, s.status
-                FROM scheduling s
-                JOIN company_profile c ON s.company_id = c.user_id
-                WHERE s.user_id = %s
-                """
-                cursor.execute(query, (user_id,))
+                run_query(cursor, "user_schedule", (user_id,))
                 results = cursor.fetchall()
 
         # Format the output
@@ -658,13 +774,7 @@ def get_company_schedule():
             cursor = conn.cursor()
 
             # Fetch schedule and user profile details
-            query = """
-                SELECT s.user_id, s.reason, s.status, s.date, s.time, u.name, u.location, u.profile_image , s.id
-                FROM scheduling s
-                JOIN user_profile u ON s.user_id = u.user_id
-                WHERE s.company_id = %s
-            """
-            cursor.execute(query, (user_id,))
+            run_query(cursor, "company_schedule", (user_id,))
             results = cursor.fetchall()
 
         # Format the output
@@ -753,8 +863,32 @@ def reject_schedule():
         if not all([scheduling_id, company_id, user_id, reason, new_date]):
             return jsonify({"error": "Missing required fields"}), 400
 
+        try:
+            new_slot_date = parse_date(new_date)
+        except ValueError:
+            return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT date, time FROM scheduling
+                    WHERE id = %s AND company_id = %s AND user_id = %s
+                    FOR UPDATE
+                """, (scheduling_id, company_id, user_id))
+                existing = cursor.fetchone()
+
+                if not existing:
+                    return jsonify({"error": "No matching schedule found"}), 404
+
+                # Move the booking to the same slot on the new date
+                old_date, booked_time = existing
+                if booked_time and old_date != new_slot_date:
+                    slot = slot_start(booked_time.strftime('%H:%M:%S'))
+                    capacity, _, _ = get_slot_settings(cursor, company_id)
+                    book_slot(cursor, company_id, new_slot_date, slot, capacity)
+                    if old_date:
+                        release_slot(cursor, company_id, old_date, slot)
+
                 # Update scheduling table to set status as rejected, store reason, and update date
                 cursor.execute("""
                     UPDATE scheduling 
@@ -762,18 +896,155 @@ def reject_schedule():
                     WHERE id = %s AND company_id = %s AND user_id = %s
                 """, (reason, new_date, scheduling_id, company_id, user_id))
 
-                # Check if any row was updated
-                if cursor.rowcount == 0:
-                    return jsonify({"error": "No matching schedule found"}), 404
-
                 conn.commit()
 
         return jsonify({"message": "Schedule rejected successfully"}), 200
 
+    except SlotUnavailableError as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         logging.error(f"Error rejecting schedule: {str(e)}")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
+@app.route('/companyAvailability', methods=['GET'])
+def company_availability():
+    """Return the free pickup slots of a company for each day in a date range."""
+    try:
+        company_id = request.args.get('company_id')
+        date_from = request.args.get('from')
+        date_to = request.args.get('to') or date_from
+
+        if not company_id or not date_from:
+            return jsonify({"error": "company_id and from are required"}), 400
+
+        try:
+            company_id = int(company_id)
+        except ValueError:
+            return jsonify({"error": "company_id must be an integer"}), 400
+
+        try:
+            date_from = parse_date(date_from)
+            date_to = parse_date(date_to)
+        except ValueError:
+            return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+
+        if date_to < date_from or (date_to - date_from).days >= MAX_AVAILABILITY_DAYS:
+            return jsonify({"error": f"Date range must cover 1 to {MAX_AVAILABILITY_DAYS} days"}), 400
+
+        return jsonify({
+            "company_id": company_id,
+            "availability": get_availability(company_id, date_from, date_to)
+        }), 200
+
+    except Exception as e:
+        logging.error(f"Error fetching availability: {str(e)}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+@app.route('/companySlotSettings', methods=['POST'])
+def company_slot_settings():
+    """Set a company's booking capacity per slot and its pickup hours."""
+    try:
+        data = request.get_json() or {}
+        company_id = data.get('company_id')
+        capacity = data.get('slot_capacity')
+        open_time = data.get('open_time')
+        close_time = data.get('close_time')
+
+        if not company_id:
+            return jsonify({"error": "company_id is required"}), 400
+
+        try:
+            company_id = int(company_id)
+            capacity = int(capacity) if capacity is not None else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "company_id and slot_capacity must be integers"}), 400
+
+        if capacity is not None and capacity < 1:
+            return jsonify({"error": "slot_capacity must be at least 1"}), 400
+
+        # Hours are optional, but must be given together
+        if bool(open_time) != bool(close_time):
+            return jsonify({"error": "open_time and close_time must be set together"}), 400
+
+        if open_time:
+            try:
+                open_time = parse_time(open_time)
+                close_time = parse_time(close_time)
+            except ValueError:
+                return jsonify({"error": "open_time and close_time must be HH:MM"}), 400
+
+            if open_time >= close_time:
+                return jsonify({"error": "open_time must be before close_time"}), 400
+
+            # Bookings are rounded down to slot boundaries, so hours must sit on them too
+            if not on_slot_grid(open_time) or not on_slot_grid(close_time):
+                return jsonify({
+                    "error": f"open_time and close_time must be on a {SLOT_MINUTES}-minute boundary"
+                }), 400
+
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                if not update_slot_settings(cursor, company_id, capacity, open_time or None, close_time or None):
+                    return jsonify({"error": "Company profile not found"}), 404
+                conn.commit()
+
+        return jsonify({
+            "message": "Slot settings updated successfully",
+            "settings": {
+                "company_id": company_id,
+                "slot_capacity": capacity,
+                "open_time": open_time.strftime('%H:%M') if open_time else None,
+                "close_time": close_time.strftime('%H:%M') if close_time else None
+            }
+        }), 200
+
+    except Exception as e:
+        logging.error(f"Error updating slot settings: {str(e)}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
+@app.route('/admissionMetrics', methods=['GET'])
+@admin_required
+def admission_metrics():
+    """Report admitted and shed request counts for rate-limited routes."""
+    return jsonify({"routes": get_admission_metrics()}), 200
+
+@app.route('/queryStats', methods=['GET'])
+@admin_required
+def query_stats():
+    """Report per-query timings and row counts for the registered hot queries."""
+    return jsonify({"queries": get_query_stats()}), 200
+
+@app.route('/admin/export/<table>', methods=['GET'])
+@admin_required
+@admission_control('export', max_concurrent=2, max_queue=0, rate=0.05, burst=3, queue_timeout=0)
+def export_table(table):
+    """Stream a CSV or Parquet dump of wasteimages or scheduling straight from Postgres."""
+    try:
+        fmt = request.args.get('format', 'csv')
+        checkpoint = request.args.get('checkpoint')  # only rows added since this checkpoint
+
+        copy_sql, checkpoint_id = plan_export(
+            table,
+            fmt=fmt,
+            date_from=request.args.get('from'),
+            date_to=request.args.get('to'),
+            checkpoint=checkpoint
+        )
+
+        body = stream_export(table, copy_sql, fmt=fmt, checkpoint=checkpoint, checkpoint_id=checkpoint_id)
+        mimetype = "text/csv" if fmt == "csv" else "application/vnd.apache.parquet"
+        return Response(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f"attachment; filename={table}.{fmt}"}
+        )
+
+    except ExportError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Export error: {str(e)}")
+        return jsonify({"error": f"An error occurred: {str(e)}"}), 500
+
 
 # Run the Flask app
 if __name__ == "__main__":
@@ -0,0 +1,331 @@
+import io
+import queue
+import logging
+import threading
+from datetime import datetime, timedelta
+from db_utils import get_db_connection
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Tables that can be exported, with their columns and the column used for date filters.
+# Parquet types are given for id columns; everything else keeps its Postgres text form.
+EXPORTS = {
+    "wasteimages": {
+        "columns": ["id", "user_id", "level", "image", "time"],
+        "date_column": "time",
+    },
+    "scheduling": {
+        "columns": ["id", "company_id", "user_id", "date", "time", "status", "reason"],
+        "date_column": "date",
+    },
+}
+INTEGER_COLUMNS = {"id", "user_id", "company_id"}
+
+PIPE_DEPTH = 16  # max COPY chunks buffered between the database and the client
+PIPE_CHUNK_SIZE = 64 * 1024  # COPY rows are coalesced into chunks of about this size
+PARQUET_BLOCK_SIZE = 4 * 1024 * 1024
+PARQUET_ROW_GROUP_ROWS = 64 * 1024
+
+
+class ExportError(ValueError):
+    """Raised for invalid export requests."""
+
+
+class _ExportCancelled(Exception):
+    pass
+
+
+_EOF = object()
+
+
+class _ChunkPipe:
+    """Bounded hand-off between the thread running COPY and the streaming response."""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=PIPE_DEPTH)
+        self._pending = bytearray()
+        self.cancelled = threading.Event()
+
+    def _put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise _ExportCancelled()
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        # Called by cursor.copy_expert() once per COPY row; batch rows into larger chunks
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._pending += data
+        if len(self._pending) >= PIPE_CHUNK_SIZE:
+            self._put(bytes(self._pending))
+            self._pending.clear()
+        return len(data)
+
+    def finish(self, error=None):
+        try:
+            if self._pending and error is None:
+                self._put(bytes(self._pending))
+            self._pending.clear()
+            self._put((_EOF, error))
+        except _ExportCancelled:
+            pass
+
+    def chunks(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, tuple) and item[0] is _EOF:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+
+
+class _ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks, for pyarrow's CSV reader."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # Fill the whole buffer when possible; short reads make pyarrow emit tiny batches
+        view = memoryview(b).cast("B")
+        filled = 0
+        while filled < len(view):
+            if not self._buffer:
+                self._buffer = next(self._chunks, b"")
+                if not self._buffer:
+                    break
+            n = min(len(view) - filled, len(self._buffer))
+            view[filled:filled + n] = self._buffer[:n]
+            self._buffer = self._buffer[n:]
+            filled += n
+        return filled
+
+
+class _ChunkSink:
+    """Write-only file object that keeps its absolute position while being drained."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _get_checkpoint(cursor, table, name):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS export_checkpoints (
+            table_name TEXT NOT NULL,
+            name TEXT NOT NULL,
+            last_id BIGINT NOT NULL,
+            exported_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (table_name, name)
+        )
+    """)
+    cursor.execute(
+        "SELECT last_id FROM export_checkpoints WHERE table_name = %s AND name = %s",
+        (table, name)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _save_checkpoint(table, name, last_id):
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO export_checkpoints (table_name, name, last_id, exported_at)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT (table_name, name)
+                DO UPDATE SET last_id = EXCLUDED.last_id, exported_at = now()
+            """, (table, name, last_id))
+            conn.commit()
+
+
+def _parse_date(value, label):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise ExportError(f"{label} must be a date in YYYY-MM-DD format")
+
+
+def plan_export(table, fmt="csv", date_from=None, date_to=None, checkpoint=None):
+    """Build the COPY statement for an export.
+
+    Returns (copy_sql, checkpoint_id): when a checkpoint name is given, only rows added
+    since that checkpoint are selected, and checkpoint_id is the high-water id to
+    record once the export has been fully streamed. Checkpoints cannot be combined
+    with a date range, since advancing past filtered-out rows would skip them for good.
+    """
+    if table not in EXPORTS:
+        raise ExportError(f"Unknown export table: {table}")
+    if fmt not in ("csv", "parquet"):
+        raise ExportError(f"Unsupported export format: {fmt}")
+    if fmt == "parquet" and pa is None:
+        raise ExportError("Parquet export requires pyarrow to be installed")
+    if checkpoint and (date_from or date_to):
+        raise ExportError("checkpoint cannot be combined with from/to")
+
+    spec = EXPORTS[table]
+    conditions = []
+    params = []
+
+    if date_from:
+        conditions.append(f"{spec['date_column']} >= %s")
+        params.append(_parse_date(date_from, "from"))
+    if date_to:
+        # "to" is inclusive, matching /companyAvailability
+        conditions.append(f"{spec['date_column']} < %s")
+        params.append(_parse_date(date_to, "to") + timedelta(days=1))
+
+    checkpoint_id = None
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            if checkpoint:
+                last_id = _get_checkpoint(cursor, table, checkpoint)
+                # Fix the upper bound now so rows inserted mid-export go to the next run
+                cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+                checkpoint_id = max(cursor.fetchone()[0], last_id)
+                conditions.append("id > %s AND id <= %s")
+                params.extend([last_id, checkpoint_id])
+                conn.commit()
+
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            select = f"SELECT {', '.join(spec['columns'])} FROM {table} {where} ORDER BY id"
+            copy_sql = cursor.mogrify(
+                f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)", params
+            ).decode("utf-8")
+
+    return copy_sql, checkpoint_id
+
+
+def _run_copy(copy_sql, pipe):
+    error = None
+    try:
+        with get_db_connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.copy_expert(copy_sql, pipe)
+            except Exception as e:
+                # Keep the COPY error even if the rollback on exit fails too, and keep an
+                # aborted COPY connection out of the pool
+                error = e
+                conn.discard = True
+                raise
+    except Exception as e:
+        error = error or e
+
+    if error is not None and pipe.cancelled.is_set():
+        logger.info("Export cancelled by client")
+        error = None
+    elif error is not None:
+        logger.error(f"Export COPY error: {str(error)}")
+
+    pipe.finish(error)
+
+
+def _stream_csv(copy_sql):
+    pipe = _ChunkPipe()
+    worker = threading.Thread(target=_run_copy, args=(copy_sql, pipe), daemon=True)
+    worker.start()
+    try:
+        yield from pipe.chunks()
+    finally:
+        # Stops the COPY thread if the client disconnected early
+        pipe.cancelled.set()
+
+
+def _stream_parquet(table, csv_chunks):
+    column_types = {col: pa.int64() if col in INTEGER_COLUMNS else pa.string()
+                    for col in EXPORTS[table]["columns"]}
+    reader = pa_csv.open_csv(
+        _ChunkReader(csv_chunks),
+        read_options=pa_csv.ReadOptions(block_size=PARQUET_BLOCK_SIZE),
+        # Free-text columns (e.g. scheduling.reason) can hold quoted newlines
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        # COPY writes NULL as an unquoted empty field and '' as a quoted one
+        convert_options=pa_csv.ConvertOptions(
+            column_types=column_types,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+
+    sink = _ChunkSink()
+    try:
+        with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), reader.schema) as writer:
+            # Collect batches into row groups of about PARQUET_ROW_GROUP_ROWS rows
+            pending = []
+            pending_rows = 0
+            for batch in reader:
+                pending.append(batch)
+                pending_rows += batch.num_rows
+                if pending_rows >= PARQUET_ROW_GROUP_ROWS:
+                    writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+                    pending = []
+                    pending_rows = 0
+                    yield sink.drain()
+            if pending:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+        yield sink.drain()
+    finally:
+        csv_chunks.close()
+
+
+def stream_export(table, copy_sql, fmt="csv", checkpoint=None, checkpoint_id=None):
+    """Generate the export body chunk by chunk, advancing the checkpoint at the end."""
+    chunks = _stream_csv(copy_sql)
+    if fmt == "parquet":
+        chunks = _stream_parquet(table, chunks)
+
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+    finally:
+        chunks.close()
+
+    # Only reached when the whole export was sent
+    if checkpoint:
+        _save_checkpoint(table, checkpoint, checkpoint_id)
@@ -0,0 +1,142 @@
+import io
+import os
+import socket
+import logging
+import tempfile
+import ipaddress
+import requests
+from urllib.parse import urljoin, urlparse
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the size of a single uploaded image
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+FETCH_TIMEOUT = (5, 20)  # (connect, read) seconds
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 3
+# Largest decoded image accepted (about a 48 MP photo); checked before any pixels are loaded
+MAX_IMAGE_PIXELS = 48_000_000
+
+# Longest side images are downsized to before inference. Both Spaces return
+# detections (the waste model reports several classes per image), so both are
+# treated as 640px detectors until the classifier's input size is confirmed.
+BIN_DETECTION_SIZE = 640
+WASTE_CLASSIFICATION_SIZE = 640
+
+JPEG_QUALITY = 90
+
+# Shared HTTP session so image downloads reuse pooled connections
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+
+class ImageValidationError(ValueError):
+    """Raised when an uploaded image cannot be fetched or is not a valid image."""
+
+
+def _check_public_url(url):
+    """Reject URLs that are not http(s) or resolve to internal addresses (SSRF guard)."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ImageValidationError("Image URL must be an http(s) URL")
+
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, None, proto=socket.IPPROTO_TCP)
+    except socket.gaierror:
+        raise ImageValidationError(f"Could not resolve image host {parsed.hostname}")
+
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ImageValidationError("Image URL points to a non-public address")
+
+
+def fetch_image(image_url):
+    """Download an image once, enforcing the size cap while streaming.
+
+    Redirects are followed by hand so every hop goes through the SSRF check.
+    The content type is not trusted; the bytes are validated when decoded.
+    """
+    try:
+        url = image_url
+        for _ in range(MAX_REDIRECTS + 1):
+            _check_public_url(url)
+            response = _session.get(url, stream=True, timeout=FETCH_TIMEOUT, allow_redirects=False)
+            if not response.is_redirect:
+                break
+            url = urljoin(url, response.headers["Location"])
+            response.close()
+        else:
+            raise ImageValidationError("Too many redirects while fetching image")
+
+        with response:
+            response.raise_for_status()
+
+            content_length = response.headers.get("Content-Length", "")
+            if content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+                raise ImageValidationError("Image exceeds the maximum allowed size")
+
+            buffer = io.BytesIO()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                buffer.write(chunk)
+                if buffer.tell() > MAX_IMAGE_BYTES:
+                    raise ImageValidationError("Image exceeds the maximum allowed size")
+
+            return buffer.getvalue()
+
+    except requests.RequestException as e:
+        raise ImageValidationError(f"Could not fetch image: {str(e)}")
+
+
+def resize_image(data, size):
+    """Decode image bytes, downsize to fit within size x size and re-encode as JPEG."""
+    try:
+        # verify() catches truncated/corrupt files but leaves the image unusable
+        Image.open(io.BytesIO(data)).verify()
+        image = Image.open(io.BytesIO(data))
+
+        # Pillow only errors above 2x its own limit, so check the header dimensions here
+        width, height = image.size
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ImageValidationError("Image dimensions are too large")
+
+        # Let JPEG decode at a reduced scale instead of inflating the full image
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+    except Image.DecompressionBombError:
+        raise ImageValidationError("Image dimensions are too large")
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        raise ImageValidationError(f"Invalid image: {str(e)}")
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=JPEG_QUALITY)
+    return output.getvalue()
+
+
+def prepare_image(image_url, size):
+    """Fetch and downsize an image, returning the path of a temporary JPEG file.
+
+    The caller is responsible for removing the file with cleanup_images().
+    """
+    data = resize_image(fetch_image(image_url), size)
+
+    fd, path = tempfile.mkstemp(suffix=".jpg", prefix="binwin_")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+    logger.debug(f"Prepared image {image_url} -> {path} ({len(data)} bytes)")
+    return path
+
+
+def cleanup_images(paths):
+    """Remove temporary image files created by prepare_image()."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
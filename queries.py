@@ -0,0 +1,140 @@
+import os
+import re
+import time
+import logging
+import threading
+from db_utils import PREPARED_STATEMENTS
+
+logger = logging.getLogger(__name__)
+
+# Queries slower than this are logged as warnings
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+
+# Hot queries, defined once. Parameters use $n placeholders in order of appearance.
+QUERIES = {
+    "login_lookup": """
+        SELECT id, email, password, role, time FROM users WHERE email = $1
+    """,
+    "login_touch": """
+        UPDATE users SET time = $1 WHERE email = $2
+    """,
+    "quiz_add_points": """
+        UPDATE user_profile
+        SET points = COALESCE(points, 0) + $1
+        WHERE user_id = $2
+        RETURNING user_id, points
+    """,
+    "profile_exists": """
+        SELECT id FROM user_profile WHERE user_id = $1
+    """,
+    "profile_fetch": """
+        SELECT id, user_id, name, bio, location, age, profile_image, coordinates,
+               level, points, visit, streaks, waste_weight
+        FROM user_profile WHERE user_id = $1
+    """,
+    "company_profile_exists": """
+        SELECT id FROM company_profile WHERE user_id = $1
+    """,
+    "company_profile_fetch": """
+        SELECT id, user_id, company_name, location, coordinates, contact_number,
+               profile_image, visit, building_images
+        FROM company_profile
+        WHERE user_id = $1
+    """,
+    "profile_batch": """
+        SELECT id, user_id, name, bio, location, age, profile_image, coordinates,
+               level, points, visit, streaks, waste_weight
+        FROM user_profile WHERE user_id = ANY($1)
+    """,
+    "company_profile_batch": """
+        SELECT id, user_id, company_name, location, coordinates, contact_number,
+               profile_image, visit, building_images
+        FROM company_profile
+        WHERE user_id = ANY($1)
+    """,
+    "leaderboard": """
+        SELECT user_id, name, profile_image, points, streaks
+        FROM user_profile
+        ORDER BY points DESC
+        LIMIT 20
+    """,
+    "user_locations": """
+        SELECT user_id, name, bio, coordinates FROM user_profile WHERE coordinates IS NOT NULL
+    """,
+    "company_location": """
+        SELECT company_name, coordinates FROM company_profile WHERE user_id = $1 AND coordinates IS NOT NULL
+    """,
+    "user_schedule": """
+        SELECT s.id , s.company_id, s.date, s.time, c.company_name, c.contact_number, c.profile_image, c.price, s.status
+        FROM scheduling s
+        JOIN company_profile c ON s.company_id = c.user_id
+        WHERE s.user_id = $1
+    """,
+    "company_schedule": """
+        SELECT s.user_id, s.reason, s.status, s.date, s.time, u.name, u.location, u.profile_image , s.id
+        FROM scheduling s
+        JOIN user_profile u ON s.user_id = u.user_id
+        WHERE s.company_id = $1
+    """,
+    "company_slot_settings": """
+        SELECT slot_capacity, open_time, close_time FROM company_profile WHERE user_id = $1
+    """,
+    "company_slots": """
+        SELECT slot_date, slot_time, booked, capacity
+        FROM schedule_slots
+        WHERE company_id = $1 AND slot_date BETWEEN $2 AND $3
+    """,
+}
+
+_PLACEHOLDER = re.compile(r"\$\d+")
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(name, elapsed_ms, rows):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0, "slow": 0})
+        stats["calls"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["rows"] += max(rows, 0)
+        if elapsed_ms >= SLOW_QUERY_MS:
+            stats["slow"] += 1
+
+    if elapsed_ms >= SLOW_QUERY_MS:
+        logger.warning(f"Slow query {name}: {elapsed_ms:.1f} ms, {rows} rows")
+
+
+def run_query(cursor, name, params=()):
+    """Execute a registered query, as a prepared statement when enabled, and time it."""
+    sql = QUERIES[name]
+    start = time.perf_counter()
+    try:
+        if PREPARED_STATEMENTS:
+            conn = cursor.connection
+            if name not in conn.prepared:
+                cursor.execute(f"PREPARE {name} AS {sql}")
+                conn.prepared.add(name)
+            if params:
+                placeholders = ", ".join(["%s"] * len(params))
+                cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+            else:
+                cursor.execute(f"EXECUTE {name}")
+        else:
+            cursor.execute(_PLACEHOLDER.sub("%s", sql), params)
+    except Exception as e:
+        logger.error(f"Query {name} failed: {str(e)}")
+        raise
+
+    _record(name, (time.perf_counter() - start) * 1000, cursor.rowcount)
+    return cursor
+
+
+def get_query_stats():
+    """Per-query call counts, timings and row counts."""
+    with _stats_lock:
+        return {
+            name: dict(stats, avg_ms=stats["total_ms"] / stats["calls"])
+            for name, stats in _stats.items()
+        }
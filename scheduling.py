@@ -0,0 +1,202 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from db_utils import get_db_connection
+from queries import run_query
+
+logger = logging.getLogger(__name__)
+
+# Default pickup slot grid, used for companies that have not set their own hours
+SLOT_MINUTES = int(os.environ.get("SLOT_MINUTES", 60))
+DAY_START = os.environ.get("SLOT_DAY_START", "09:00")
+DAY_END = os.environ.get("SLOT_DAY_END", "18:00")
+# Bookings allowed per slot for companies that have not set slot_capacity
+SLOT_CAPACITY = int(os.environ.get("SLOT_CAPACITY", 1))
+# Reject bookings outside the default grid for companies without their own hours
+ENFORCE_SLOT_HOURS = os.environ.get("ENFORCE_SLOT_HOURS", "0") == "1"
+
+MAX_AVAILABILITY_DAYS = 31
+
+
+class SlotUnavailableError(Exception):
+    """Raised when the requested slot is already fully booked."""
+
+
+def parse_date(value):
+    """Parse YYYY-MM-DD; raises ValueError for anything else, including non-strings."""
+    if not isinstance(value, str):
+        raise ValueError("date must be a string")
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def parse_time(value):
+    """Parse HH:MM or HH:MM:SS; raises ValueError for anything else, including non-strings."""
+    if not isinstance(value, str):
+        raise ValueError("time must be a string")
+    return datetime.strptime(value, "%H:%M:%S" if value.count(":") == 2 else "%H:%M").time()
+
+
+def on_slot_grid(value):
+    """Whether a time falls exactly on a slot boundary (a multiple of SLOT_MINUTES)."""
+    return value.second == 0 and (value.hour * 60 + value.minute) % SLOT_MINUTES == 0
+
+
+def slot_start(value):
+    """Round a time string (HH:MM or HH:MM:SS) down to the start of its slot."""
+    parsed = parse_time(value)
+    minutes = parsed.hour * 60 + parsed.minute
+    minutes -= minutes % SLOT_MINUTES
+    return parsed.replace(hour=minutes // 60, minute=minutes % 60, second=0)
+
+
+def day_slots(open_time=None, close_time=None):
+    """All slot start times between open_time and close_time (default grid if unset)."""
+    day = datetime.min.date()
+    start = datetime.combine(day, open_time or parse_time(DAY_START))
+    end = datetime.combine(day, close_time or parse_time(DAY_END))
+    slots = []
+    while start + timedelta(minutes=SLOT_MINUTES) <= end:
+        slots.append(start.time())
+        start += timedelta(minutes=SLOT_MINUTES)
+    return slots
+
+
+def within_hours(slot, open_time, close_time):
+    """Whether a slot can be booked given a company's hours (None when unset)."""
+    if open_time and close_time:
+        return slot in day_slots(open_time, close_time)
+    if ENFORCE_SLOT_HOURS:
+        return slot in day_slots()
+    return True
+
+
+def migrate():
+    """Create the per-company slot settings and the schedule_slots index.
+
+    Run once on deploy with `python scheduling.py`; it takes locks on company_profile
+    so it must not run from request handlers. Each schedule_slots row counts the
+    bookings in one (company, date, slot), so availability and conflict checks touch
+    a handful of rows instead of the whole booking history. Re-running it recomputes
+    the booked counts from scheduling.
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            # Per-company booking settings; NULL means use the defaults above
+            cursor.execute("""
+                ALTER TABLE company_profile
+                    ADD COLUMN IF NOT EXISTS slot_capacity INTEGER,
+                    ADD COLUMN IF NOT EXISTS open_time TIME,
+                    ADD COLUMN IF NOT EXISTS close_time TIME
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schedule_slots (
+                    company_id INTEGER NOT NULL,
+                    slot_date DATE NOT NULL,
+                    slot_time TIME NOT NULL,
+                    booked INTEGER NOT NULL DEFAULT 0 CHECK (booked >= 0),
+                    capacity INTEGER NOT NULL,
+                    PRIMARY KEY (company_id, slot_date, slot_time)
+                )
+            """)
+            cursor.execute("""
+                INSERT INTO schedule_slots (company_id, slot_date, slot_time, booked, capacity)
+                SELECT s.company_id, s.date,
+                       s.time - make_interval(secs => extract(epoch FROM s.time)::int %% %s),
+                       COUNT(*), COALESCE(MAX(c.slot_capacity), %s)
+                FROM scheduling s
+                LEFT JOIN company_profile c ON c.user_id = s.company_id
+                WHERE s.date IS NOT NULL AND s.time IS NOT NULL
+                GROUP BY 1, 2, 3
+                ON CONFLICT (company_id, slot_date, slot_time)
+                DO UPDATE SET booked = EXCLUDED.booked
+            """, (SLOT_MINUTES * 60, SLOT_CAPACITY))
+            logger.info(f"Indexed {cursor.rowcount} booked slots into schedule_slots")
+
+            conn.commit()
+
+
+def get_slot_settings(cursor, company_id):
+    """(capacity, open_time, close_time) for a company, with defaults filled in for capacity."""
+    run_query(cursor, "company_slot_settings", (company_id,))
+    row = cursor.fetchone() or (None, None, None)
+    return row[0] or SLOT_CAPACITY, row[1], row[2]
+
+
+def book_slot(cursor, company_id, date, slot, capacity):
+    """Reserve one place in a slot within the caller's transaction.
+
+    The guarded UPDATE takes the slot row lock, so concurrent bookings of the same
+    slot are serialised and can never exceed its capacity.
+    """
+    cursor.execute("""
+        INSERT INTO schedule_slots (company_id, slot_date, slot_time, booked, capacity)
+        VALUES (%s, %s, %s, 0, %s)
+        ON CONFLICT DO NOTHING
+    """, (company_id, date, slot, capacity))
+    cursor.execute("""
+        UPDATE schedule_slots
+        SET booked = booked + 1
+        WHERE company_id = %s AND slot_date = %s AND slot_time = %s AND booked < capacity
+    """, (company_id, date, slot))
+
+    if cursor.rowcount == 0:
+        raise SlotUnavailableError(f"Slot {date} {slot.strftime('%H:%M')} is fully booked")
+
+
+def release_slot(cursor, company_id, date, slot):
+    """Give back one place in a slot within the caller's transaction."""
+    cursor.execute("""
+        UPDATE schedule_slots
+        SET booked = GREATEST(booked - 1, 0)
+        WHERE company_id = %s AND slot_date = %s AND slot_time = %s
+    """, (company_id, date, slot))
+
+
+def update_slot_settings(cursor, company_id, capacity, open_time, close_time):
+    """Store a company's booking settings and apply the capacity to its upcoming slots.
+
+    Returns False when the company has no profile.
+    """
+    cursor.execute("""
+        UPDATE company_profile
+        SET slot_capacity = %s, open_time = %s, close_time = %s
+        WHERE user_id = %s
+    """, (capacity, open_time, close_time, company_id))
+    if cursor.rowcount == 0:
+        return False
+
+    cursor.execute("""
+        UPDATE schedule_slots
+        SET capacity = %s
+        WHERE company_id = %s AND slot_date >= CURRENT_DATE
+    """, (capacity or SLOT_CAPACITY, company_id))
+    return True
+
+
+def get_availability(company_id, date_from, date_to):
+    """Free slots per day for a company between date_from and date_to inclusive."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            capacity, open_time, close_time = get_slot_settings(cursor, company_id)
+            run_query(cursor, "company_slots", (company_id, date_from, date_to))
+            taken = {(row[0], row[1]): row[3] - row[2] for row in cursor.fetchall()}
+
+    slots = day_slots(open_time, close_time)
+    days = []
+    date = date_from
+    while date <= date_to:
+        free = []
+        for slot in slots:
+            remaining = taken.get((date, slot), capacity)
+            if remaining > 0:
+                free.append({"time": slot.strftime("%H:%M"), "remaining": remaining})
+        days.append({"date": date.strftime("%Y-%m-%d"), "slots": free})
+        date += timedelta(days=1)
+
+    return days
+
+
+# Run the one-off schema migration
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()